@@ -4,17 +4,24 @@ Created on Thu Jan 29 15:01:18 2026
 
 @author: zhiha
 """
-import os
+import math
+import shutil
+import sys
 
-# --- 1. HEADLESS DISPLAY SETUP (CRITICAL FOR CLOUD) ---
-# We must start the "fake screen" before importing PyVista
-os.system('/usr/bin/Xvfb :99 -screen 0 1024x768x24 &')
-os.environ['DISPLAY'] = ':99'
 import streamlit as st
 import pyvista as pv
 import numpy as np
-import matplotlib.pyplot as plt
-from stpyvista import stpyvista
+
+# --- 1. HEADLESS DISPLAY SETUP (CRITICAL FOR CLOUD) ---
+# Start the "fake screen" once per server process, not on every rerun
+@st.cache_resource(show_spinner=False)
+def _start_xvfb():
+    pv.start_xvfb()
+
+# Only on Linux hosts with Xvfb installed; elsewhere (e.g. running locally
+# on Windows) there is a real display and start_xvfb would raise OSError
+if sys.platform.startswith("linux") and shutil.which("Xvfb"):
+    _start_xvfb()
 
 # ==========================================
 # 1. PROFESSIONAL PAGE SETUP
@@ -46,48 +53,71 @@ with st.sidebar:
     st.markdown("---")
     
     st.header("🎛️ Operation Parameters")
+    # Time drives both the velocity field and the KPIs, so it stays global.
+    # Section-specific controls live inside their fragments (see MAIN LAYOUT).
     with st.expander("Process Inputs", expanded=True):
-        fluid_ratio = st.slider("Fluid A Proportion (%)", 0, 100, 49)
         time_step = st.slider("Simulation Time (s)", 0.0, 10.0, 0.5)
 
-    with st.expander("Visualization Settings", expanded=False):
-        cmap_choice = st.selectbox("Color Map", ["jet", "viridis", "plasma", "coolwarm"], index=0)
-        v_max = st.slider("Legend Max (m/s)", 1.0, 20.0, 5.0)
-
 # ==========================================
 # 3. HELPER FUNCTION: LOAD DATA
 # ==========================================
 # We cache this so we don't reload the file 3 times per second
-@st.cache_resource
+@st.cache_resource(show_spinner=False, ttl=None, max_entries=1)
 def load_mesh():
+    # A bad case file logs VTK errors and reads as an empty MultiBlock
+    # (IndexError). pyvista.core.errors.VTKExecutionError only exists from
+    # pyvista 0.47 and pv.read doesn't raise it, so it isn't listed here.
     try:
         multiblock = pv.read("master.case")
         grid = multiblock[0]
-        return grid
-    except:
-        # Dummy if missing
-        return pv.Cylinder(radius=0.5, height=1.2, direction=(0,0,1))
+    except (FileNotFoundError, IndexError):
+        # Dummy if missing (or the case file holds no blocks)
+        grid = pv.Cylinder(radius=0.5, height=1.2, direction=(0,0,1))
+
+    # The renderer works in float32; halve what we ship to the browser
+    grid.points = grid.points.astype(np.float32)
+    for data in (grid.point_data, grid.cell_data):
+        for name in list(data.keys()):
+            if data[name].dtype == np.float64:
+                data[name] = data[name].astype(np.float32)
+
+    # Generate placeholder velocities once, not on every rerun
+    if "velocity" not in grid.array_names:
+        rng = np.random.default_rng(0)
+        grid["velocity"] = rng.random((grid.n_points, 3), dtype=np.float32)
+
+    # Internal edges are invisible anyway, so the mesh viewer only needs the
+    # outer skin; extract it here so it shares the grid's cache entry
+    surface = grid.extract_surface()
+    return grid, surface
+
+# Mesh statistics can't change after load (volume needs a full integration)
+@st.cache_resource
+def _grid_stats(_grid):
+    return _grid.n_cells, _grid.n_points, _grid.volume
 
 # ==========================================
 # 4. VISUALIZATION ENGINES
 # ==========================================
 
 # --- ENGINE A: VELOCITY SLICE ---
-def get_velocity_model(grid, t, cmap, clim_max):
-    # Apply Physics (Pulse)
-    pulse = np.abs(np.sin(t)) + 0.5
-    
-    # Create temp array for display
-    # We copy to avoid corrupting the cached original
-    display_grid = grid.copy(deep=False) 
-    
-    if "velocity" not in display_grid.array_names:
-        display_grid["velocity"] = np.random.rand(display_grid.n_points, 3)
-    
-    display_grid["display_vel"] = display_grid["velocity"] * pulse
+# The slice geometry never changes, so we cut it once and reuse it.
+# Leading underscore tells Streamlit not to hash the (cached) grid.
+@st.cache_resource
+def _cached_slice(_grid):
+    slice_plane = _grid.slice(normal='z', origin=(0, 0, 0.5))
+    # Only the magnitude is ever colored, so keep a 1-D copy per slice point
+    slice_vel_mag = np.ascontiguousarray(
+        np.linalg.norm(slice_plane["velocity"], axis=1), dtype=np.float32)
+    return slice_plane, slice_vel_mag
 
-    # Slice
-    slice_plane = display_grid.slice(normal='z', origin=(0, 0, 0.5))
+def get_velocity_model(grid, pulse, cmap, clim_max):
+    # Only the scalar field changes between reruns
+    cached_slice, slice_vel_mag = _cached_slice(grid)
+    # The cached slice is shared by every session (one thread each), so each
+    # run scales into its own array on a shallow copy of the geometry
+    slice_plane = cached_slice.copy(deep=False)
+    slice_plane["display_vel"] = np.multiply(slice_vel_mag, pulse, dtype=np.float32)
 
     plotter = pv.Plotter(window_size=[800, 600])
     plotter.set_background("white")
@@ -104,30 +134,43 @@ def get_velocity_model(grid, t, cmap, clim_max):
     return plotter
 
 # --- ENGINE B: FULL MESH VIEWER ---
-def get_mesh_model(grid):
-    plotter = pv.Plotter(window_size=[800, 600])
+def get_mesh_model(surface):
+    # Off-screen: this view is rendered to a still image (see _mesh_png)
+    plotter = pv.Plotter(off_screen=True, window_size=[800, 600])
     plotter.set_background("white")
     
-    # 1. Show the solid surface (Semi-transparent)
-    plotter.add_mesh(grid, color="lightblue", opacity=0.3, show_scalar_bar=False)
-    
-    # 2. Show the Wireframe (The "Mesh" lines)
+    # Semi-transparent surface plus the "Mesh" lines in a single actor
     # We use 'show_edges=True' to reveal the mesh structure
-    plotter.add_mesh(grid, style='wireframe', color="black", opacity=0.1, line_width=0.5)
+    plotter.add_mesh(surface, color="lightblue", opacity=0.3, show_edges=True,
+                     edge_color="black", line_width=0.5, show_scalar_bar=False)
     
     plotter.add_axes() # Show XYZ arrows
     plotter.view_isometric()
     return plotter
 
+# The geometry view has no user controls, so render it once to a PNG
+# instead of streaming a live VTK scene on every reconnect
+@st.cache_resource
+def _mesh_png(_surface):
+    plotter = get_mesh_model(_surface)
+    img = plotter.screenshot(return_img=True)
+    plotter.close()
+    return img
+
 # --- ENGINE C: GRAPH ---
+# Homogeneity curve is constant, so compute it once at import
+_X = np.linspace(0, 100, 100)
+_Y = 0.05 * (_X - 50)**2 + 10
+
 def get_mixing_graph(current_ratio):
+    # Imported here so matplotlib only loads when the graph is drawn
+    import matplotlib.pyplot as plt
+
     plt.style.use('seaborn-v0_8-whitegrid')
-    x = np.linspace(0, 100, 100)
-    y = 0.05 * (x - 50)**2 + 10
     current_y = 0.05 * (current_ratio - 50)**2 + 10
     
     fig, ax = plt.subplots(figsize=(12, 3.5))
-    ax.plot(x, y, color='#004e89', linewidth=2.5)
+    ax.plot(_X, _Y, color='#004e89', linewidth=2.5)
     ax.scatter([current_ratio], [current_y], color='#ff4b4b', s=120, zorder=5, edgecolors='black')
     ax.axvline(x=current_ratio, color='#ff4b4b', linestyle=':', alpha=0.6)
     
@@ -142,27 +185,50 @@ def get_mixing_graph(current_ratio):
 st.title("🏭 Mixing Process Digital Twin")
 
 # Load Data Once
-grid = load_mesh()
+grid, surface = load_mesh()
+
+# Apply Physics (Pulse): shared by the velocity field and the KPIs
+sin_t = math.sin(time_step)
+pulse = abs(sin_t) + 0.5
+
+# Fragments: a widget inside one only reruns that section, not the whole script
 
 # --- PART 1: VELOCITY ---
-st.subheader("Velocity Field Analysis")
-plotter_vel = get_velocity_model(grid, time_step, cmap_choice, v_max)
-key_vel = f"vel_{fluid_ratio}_{time_step}_{cmap_choice}_{v_max}"
-stpyvista(plotter_vel, key=key_vel)
+@st.fragment
+def _velocity_panel(grid, pulse):
+    # Imported here so the page paints before the viewer backend loads
+    from stpyvista.panel_backend import stpyvista
 
-st.markdown("---")
+    with st.expander("Visualization Settings", expanded=False):
+        cmap_choice = st.selectbox("Color Map", ["jet", "viridis", "plasma", "coolwarm"], index=0)
+        v_max = st.slider("Legend Max (m/s)", 1.0, 20.0, 5.0)
+
+    plotter_vel = get_velocity_model(grid, pulse, cmap_choice, v_max)
+    # Key only on what feeds the render
+    key_vel = f"vel_{pulse}_{cmap_choice}_{v_max}"
+    stpyvista(plotter_vel, use_container_width=True, key=key_vel)
 
 # --- PART 2: PERFORMANCE ---
-st.subheader("Performance Analytics")
-fig, mixing_time = get_mixing_graph(fluid_ratio)
+@st.fragment
+def _analytics_panel(sin_t):
+    fluid_ratio = st.slider("Fluid A Proportion (%)", 0, 100, 49)
+    fig, mixing_time = get_mixing_graph(fluid_ratio)
+
+    kpi1, kpi2, kpi3, kpi4 = st.columns(4)
+    kpi1.metric("Predicted Mixing Time", f"{mixing_time:.1f} min")
+    kpi2.metric("Avg Velocity", f"{(1.2 + sin_t*0.2):.2f} m/s")
+    kpi3.metric("Homogeneity Index", "98.5%")
+    kpi4.metric("Power", f"{(12.5 + fluid_ratio/100):.1f} kW")
 
-kpi1, kpi2, kpi3, kpi4 = st.columns(4)
-kpi1.metric("Predicted Mixing Time", f"{mixing_time:.1f} min")
-kpi2.metric("Avg Velocity", f"{(1.2 + np.sin(time_step)*0.2):.2f} m/s")
-kpi3.metric("Homogeneity Index", "98.5%")
-kpi4.metric("Power", f"{(12.5 + fluid_ratio/100):.1f} kW")
+    st.pyplot(fig)
 
-st.pyplot(fig)
+st.subheader("Velocity Field Analysis")
+_velocity_panel(grid, pulse)
+
+st.markdown("---")
+
+st.subheader("Performance Analytics")
+_analytics_panel(sin_t)
 
 st.markdown("---")
 
@@ -172,17 +238,20 @@ st.subheader("Geometric & Mesh Integrity")
 col_mesh_view, col_mesh_info = st.columns([3, 1])
 
 with col_mesh_view:
-    # Interactive Mesh Viewer
-    # This one doesn't need to update often, so we use a static key or simple key
-    plotter_mesh = get_mesh_model(grid)
-    stpyvista(plotter_mesh, key="mesh_viewer_static")
+    # Static Mesh Snapshot
+    # This one never changes, so a cached image replaces the live viewer
+    st.image(_mesh_png(surface), use_container_width=True)
 
 with col_mesh_info:
     st.markdown("#### Grid Statistics")
-    # Real data from your file
-    st.metric("Total Elements", f"{grid.n_cells:,}")
-    st.metric("Total Nodes", f"{grid.n_points:,}")
-    st.metric("Mesh Volume", f"{grid.volume:.2f} m³")
+    # Real data from your file, rendered as one table instead of three metrics
+    n_cells, n_points, volume = _grid_stats(grid)
+    st.markdown(
+        "| Metric | Value |\n|---|---|\n"
+        f"| Total Elements | {n_cells:,} |\n"
+        f"| Total Nodes | {n_points:,} |\n"
+        f"| Mesh Volume | {volume:.2f} m³ |"
+    )
     
     st.info("""
     The domain uses a **tetrahedral** mesh with boundary layer refinement for accurate near-wall turbulence capture.
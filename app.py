@@ -1,17 +1,25 @@
 import streamlit as st
 import pyvista as pv
+import math
 import os
+import shutil
+import sys
 
 # --- 1. HEADLESS MODE CONFIG ---
-# This fixes the segmentation fault on cloud
-pv.start_xvfb()
+# This fixes the segmentation fault on cloud.
+# Cached so the Xvfb process is spawned once, not on every rerun.
+@st.cache_resource(show_spinner=False)
+def _start_xvfb():
+    pv.start_xvfb()
+
+# Skipped off Linux or without Xvfb, where start_xvfb raises OSError
+if sys.platform.startswith("linux") and shutil.which("Xvfb"):
+    _start_xvfb()
 
 # --- 2. IMPORT REST ---
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.patheffects as pe
-from stpyvista import stpyvista
-import plotly.graph_objects as go
+# plotly and stpyvista are imported where first used, so the title and
+# sidebar paint before those heavy modules load
 
 # ==========================================
 # 3. PAGE CONFIG & DEEP DARK CSS
@@ -93,43 +101,73 @@ with st.sidebar:
     
     st.header("🎛️ Controls")
     
+    # Time drives both the velocity field and the KPIs, so it stays global.
+    # Tab-specific controls live inside their fragments (see MAIN APP).
     with st.expander("Process Inputs", expanded=True):
-        fluid_ratio = st.slider("Fluid A Ratio (%)", 0, 100, 49)
         time_step = st.slider("Time Step (s)", 0.0, 10.0, 0.5)
 
-    with st.expander("Viz Settings", expanded=False):
-        cmap_choice = st.selectbox("Color Map", ["jet", "turbo", "magma", "viridis"], index=0)
-        v_max = st.slider("Max Velocity (m/s)", 1.0, 20.0, 5.0)
-        show_bg_grid = st.checkbox("Show Reference Grid", value=True) 
+    with st.expander("Render Settings", expanded=False):
+        high_res = st.toggle("High-resolution render", value=False)
+
+# ~2.3x fewer pixels by default; the iframe CSS scales the view to fit
+window_size = (1600, 900) if high_res else (1024, 600)
 
 # ==========================================
 # 5. HELPER FUNCTION
 # ==========================================
-@st.cache_resource
+@st.cache_resource(show_spinner=False, ttl=None, max_entries=1)
 def load_mesh():
+    # A bad case file logs VTK errors and reads as an empty MultiBlock
+    # (IndexError). pyvista.core.errors.VTKExecutionError only exists from
+    # pyvista 0.47 and pv.read doesn't raise it, so it isn't listed here.
     try:
         multiblock = pv.read("master.case")
         grid = multiblock[0]
-        return grid
-    except:
-        return pv.Cylinder(radius=0.5, height=1.2, direction=(0,0,1))
+    except (FileNotFoundError, IndexError):
+        grid = pv.Cylinder(radius=0.5, height=1.2, direction=(0,0,1))
+
+    # WebGL renders in float32, so don't ship float64 to the browser
+    grid.points = grid.points.astype(np.float32)
+    for data in (grid.point_data, grid.cell_data):
+        for name in list(data.keys()):
+            if data[name].dtype == np.float64:
+                data[name] = data[name].astype(np.float32)
+
+    if "velocity" not in grid.array_names:
+        rng = np.random.default_rng(0)
+        grid["velocity"] = rng.random((grid.n_points, 3), dtype=np.float32)
+
+    # Wireframe of the outer skin only (no internal tet edges), cached with the grid
+    surface = grid.extract_surface()
+    return grid, surface
+
+# Static once loaded, so read them once
+@st.cache_resource
+def _grid_stats(_grid):
+    return _grid.n_cells, _grid.n_points
 
 # ==========================================
 # 6. VISUALIZATION ENGINES
 # ==========================================
 
 # --- ENGINE A: VELOCITY ---
-def get_velocity_model(grid, t, cmap, clim_max, show_gridlines):
-    pulse = np.abs(np.sin(t)) + 0.5
-    display_grid = grid.copy(deep=False) 
-    
-    if "velocity" not in display_grid.array_names:
-        display_grid["velocity"] = np.random.rand(display_grid.n_points, 3)
-    display_grid["display_vel"] = display_grid["velocity"] * pulse
+# Slice geometry is static: cut once, then only rescale the scalars
+@st.cache_resource
+def _cached_slice(_grid):
+    slice_plane = _grid.slice(normal='z', origin=(0, 0, 0.5))
+    # Only the magnitude is ever colored, so keep a 1-D copy per slice point
+    slice_vel_mag = np.ascontiguousarray(
+        np.linalg.norm(slice_plane["velocity"], axis=1), dtype=np.float32)
+    return slice_plane, slice_vel_mag
 
-    slice_plane = display_grid.slice(normal='z', origin=(0, 0, 0.5))
+def get_velocity_model(grid, pulse, cmap, clim_max, show_gridlines, window_size):
+    cached_slice, slice_vel_mag = _cached_slice(grid)
+    # The cached slice is shared by every session (one thread each), so each
+    # run scales into its own array on a shallow copy of the geometry
+    slice_plane = cached_slice.copy(deep=False)
+    slice_plane["display_vel"] = np.multiply(slice_vel_mag, pulse, dtype=np.float32)
 
-    plotter = pv.Plotter(window_size=[1600, 900])
+    plotter = pv.Plotter(window_size=list(window_size))
     plotter.set_background("#000000")
     
     sargs = dict(title="Velocity (m/s)", title_font_size=16, label_font_size=14,
@@ -149,57 +187,87 @@ def get_velocity_model(grid, t, cmap, clim_max, show_gridlines):
     return plotter
 
 # --- ENGINE B: MESH ---
-def get_mesh_model(grid):
-    plotter = pv.Plotter(window_size=[1600, 900])
+def get_mesh_model(surface, window_size):
+    # Off-screen: rendered to a still image (see _mesh_png)
+    plotter = pv.Plotter(off_screen=True, window_size=list(window_size))
     plotter.set_background("#000000") 
-    plotter.add_mesh(grid, style='wireframe', color="#444444", opacity=0.3, line_width=1)
+    plotter.add_mesh(surface, style='wireframe', color="#444444", opacity=0.3, line_width=1)
     plotter.add_axes(color='white')
     plotter.show_grid(color='gray', location='outer')
     plotter.view_isometric()
     return plotter
 
+# No controls touch the mesh view, so snapshot it once instead of live VTK
+@st.cache_resource
+def _mesh_png(_surface, window_size):
+    plotter = get_mesh_model(_surface, window_size)
+    img = plotter.screenshot(return_img=True)
+    plotter.close()
+    return img
+
 # --- ENGINE C: PLOTLY GRAPH ---
-def get_mixing_graph(current_ratio):
-    x = np.linspace(0, 100, 100)
-    y = 0.05 * (x - 50)**2 + 10
-    current_y = 0.05 * (current_ratio - 50)**2 + 10
-    
-    fig = go.Figure()
+# Homogeneity curve is constant, so compute it once at import.
+# Contiguous float32 arrays take plotly's typed-array fast path.
+_X = np.ascontiguousarray(np.linspace(0, 100, 100), dtype=np.float32)
+_Y = np.ascontiguousarray(0.05 * (_X - 50)**2 + 10, dtype=np.float32)
 
-    fig.add_hrect(
-        y0=0, y1=12, 
-        line_width=0, fillcolor="#00FF7F", opacity=0.1,
-        annotation_text="OPTIMAL ZONE", annotation_position="top right",
-        annotation_font_color="#00FF7F", annotation_font_size=16
-    )
+# Curve, shading and layout never change; only the setpoint moves
+@st.cache_resource
+def _base_fig():
+    import plotly.graph_objects as go
 
-    fig.add_trace(go.Scatter(
-        x=x, y=y, mode='lines', name='Mixing Profile',
+    # Built in one constructor call. This runs once per process; the per-rerun
+    # cost is the go.Figure() copy in get_mixing_graph, which validates again
+    curve = go.Scatter(
+        x=_X, y=_Y, mode='lines', name='Mixing Profile',
         line=dict(color='#00FFFF', width=5), 
         fill='tozeroy', fillcolor='rgba(0, 255, 255, 0.1)' 
-    ))
+    )
 
-    fig.add_trace(go.Scatter(
-        x=[current_ratio], y=[current_y], mode='markers', name='Current Setpoint',
+    # Setpoint marker and drop line, patched in get_mixing_graph
+    setpoint = go.Scatter(
+        x=[0], y=[0], mode='markers', name='Current Setpoint',
         marker=dict(color='#FF00FF', size=25, line=dict(color='white', width=3)), 
         hovertemplate="Ratio: %{x}%<br>Time: %{y:.1f} min"
-    ))
-
-    fig.add_shape(type="line", x0=current_ratio, y0=0, x1=current_ratio, y1=current_y,
-        line=dict(color="#FF00FF", width=2, dash="dot")
     )
+    drop_line = dict(type="line", xref="x", yref="y", x0=0, y0=0, x1=0, y1=0,
+                     line=dict(color="#FF00FF", width=2, dash="dot"))
+
+    optimal_zone = dict(type="rect", xref="x domain", yref="y", x0=0, x1=1, y0=0, y1=12,
+                        line_width=0, fillcolor="#00FF7F", opacity=0.1)
+    optimal_label = dict(text="OPTIMAL ZONE", xref="x domain", yref="y", x=1, y=12,
+                         xanchor="right", yanchor="top", showarrow=False,
+                         font=dict(color="#00FF7F", size=16))
 
-    fig.update_layout(
-        title=dict(text="<b>Process Homogeneity Curve</b>", font=dict(size=24, color='white')),
-        template="plotly_dark",
-        paper_bgcolor='rgba(0,0,0,0)', 
-        plot_bgcolor='rgba(0,0,0,0)',
-        height=800, autosize=True,
-        margin=dict(l=50, r=50, t=80, b=50),
-        xaxis=dict(title="Fluid A Proportion (%)", title_font=dict(size=18), tickfont=dict(size=14), showgrid=True, gridcolor='#333333', zeroline=False, range=[0, 100]),
-        yaxis=dict(title="Mixing Time (min)", title_font=dict(size=18), tickfont=dict(size=14), showgrid=True, gridcolor='#333333', zeroline=False),
-        showlegend=False 
+    fig = go.Figure(
+        data=[curve, setpoint],
+        layout=dict(
+            title=dict(text="<b>Process Homogeneity Curve</b>", font=dict(size=24, color='white')),
+            template="plotly_dark",
+            paper_bgcolor='rgba(0,0,0,0)', 
+            plot_bgcolor='rgba(0,0,0,0)',
+            height=800, autosize=True,
+            margin=dict(l=50, r=50, t=80, b=50),
+            xaxis=dict(title="Fluid A Proportion (%)", title_font=dict(size=18), tickfont=dict(size=14), showgrid=True, gridcolor='#333333', zeroline=False, range=[0, 100]),
+            yaxis=dict(title="Mixing Time (min)", title_font=dict(size=18), tickfont=dict(size=14), showgrid=True, gridcolor='#333333', zeroline=False),
+            shapes=[optimal_zone, drop_line],
+            annotations=[optimal_label],
+            showlegend=False 
+        )
     )
+    return fig
+
+def get_mixing_graph(current_ratio):
+    import plotly.graph_objects as go
+
+    current_y = 0.05 * (current_ratio - 50)**2 + 10
+
+    # Copy so the cached figure is never mutated
+    fig = go.Figure(_base_fig())
+    with fig.batch_update():
+        fig.data[1].x = [current_ratio]
+        fig.data[1].y = [current_y]
+        fig.layout.shapes[-1].update(x0=current_ratio, x1=current_ratio, y1=current_y)
     return fig, current_y
 
 # ==========================================
@@ -207,45 +275,72 @@ def get_mixing_graph(current_ratio):
 # ==========================================
 st.title("Mixing Process Digital Twin")
 
-grid = load_mesh()
+grid, surface = load_mesh()
+
+# Pulse and KPI share one scalar sine per run
+sin_t = math.sin(time_step)
+pulse = abs(sin_t) + 0.5
+
 tab1, tab2, tab3 = st.tabs(["Velocity Field", "Analytics", "Geometry Check"])
 
+# Fragments: a widget inside one only reruns that tab, not the whole script
+
 # --- TAB 1: VELOCITY ---
-with tab1:
-    plotter_vel = get_velocity_model(grid, time_step, cmap_choice, v_max, show_bg_grid)
-    key_vel = f"vel_{fluid_ratio}_{time_step}_{cmap_choice}_{v_max}_{show_bg_grid}"
-    stpyvista(plotter_vel, key=key_vel)
+@st.fragment
+def _velocity_panel(grid, pulse, window_size):
+    from stpyvista.panel_backend import stpyvista
+
+    with st.expander("Viz Settings", expanded=False):
+        cmap_choice = st.selectbox("Color Map", ["jet", "turbo", "magma", "viridis"], index=0)
+        v_max = st.slider("Max Velocity (m/s)", 1.0, 20.0, 5.0)
+        show_bg_grid = st.checkbox("Show Reference Grid", value=True) 
+
+    plotter_vel = get_velocity_model(grid, pulse, cmap_choice, v_max, show_bg_grid, window_size)
+    # Key only on what feeds the render
+    key_vel = f"vel_{pulse}_{cmap_choice}_{v_max}_{show_bg_grid}_{window_size[0]}"
+    stpyvista(plotter_vel, use_container_width=True, key=key_vel)
 
 # --- TAB 2: ANALYTICS ---
-with tab2:
+@st.fragment
+def _analytics_panel(sin_t):
     st.markdown("#### Operational KPI Dashboard")
+    fluid_ratio = st.slider("Fluid A Ratio (%)", 0, 100, 49)
     fig, mixing_time = get_mixing_graph(fluid_ratio)
     kpi1, kpi2, kpi3, kpi4 = st.columns(4)
     kpi1.metric("Predicted Time", f"{mixing_time:.1f} min")
-    kpi2.metric("Avg Velocity", f"{(1.2 + np.sin(time_step)*0.2):.2f} m/s")
+    kpi2.metric("Avg Velocity", f"{(1.2 + sin_t*0.2):.2f} m/s")
     kpi3.metric("Homogeneity", "98.5%")
     kpi4.metric("Power Draw", f"{(12.5 + fluid_ratio/100):.1f} kW")
     st.markdown("---") 
     st.plotly_chart(fig, use_container_width=True)
 
+with tab1:
+    _velocity_panel(grid, pulse, window_size)
+
+with tab2:
+    _analytics_panel(sin_t)
+
 # --- TAB 3: GEOMETRY CHECK (FIXED LAYOUT) ---
 with tab3:
     # Split the screen: 3 parts Visuals, 1 part Stats
     col_viz, col_stats = st.columns([3, 1])
 
     with col_viz:
-        # The 3D Window (Automatically smaller because it fits in the column)
-        plotter_mesh = get_mesh_model(grid)
-        stpyvista(plotter_mesh, key="mesh_view_widescreen")
+        # Static snapshot (Automatically smaller because it fits in the column)
+        st.image(_mesh_png(surface, window_size), use_container_width=True)
 
     with col_stats:
         st.markdown("### 📐 Mesh Stats")
         st.markdown("---")
         
-        # Metrics Stacked Vertically
-        st.metric("Total Elements", f"{grid.n_cells:,}")
-        st.metric("Total Nodes", f"{grid.n_points:,}")
-        st.metric("Mesh Quality", "0.85 (Avg)")
+        # Stats in a single table instead of stacked metrics
+        n_cells, n_points = _grid_stats(grid)
+        st.markdown(
+            "| Metric | Value |\n|---|---|\n"
+            f"| Total Elements | {n_cells:,} |\n"
+            f"| Total Nodes | {n_points:,} |\n"
+            "| Mesh Quality | 0.85 (Avg) |"
+        )
         
         st.markdown("---")
         st.info("Grey Wireframe Mode Active")